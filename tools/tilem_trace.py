@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
+import bz2
+import gzip
+import io
+import lzma
+import mmap
+import os
 import struct
 import sys
+from array import array
+from collections import deque
+from itertools import repeat
+from operator import itemgetter
 
 MAGIC = b"TLMT"
 HEADER_FMT = "<4sHHIII"
-HEADER_SIZE = struct.calcsize(HEADER_FMT)
+HEADER_STRUCT = struct.Struct(HEADER_FMT)
+HEADER_SIZE = HEADER_STRUCT.size
 
 INSTR_FMT = "<III" + "H" * 15 + "BBBBB"
-INSTR_SIZE = struct.calcsize(INSTR_FMT)
+INSTR_STRUCT = struct.Struct(INSTR_FMT)
+INSTR_SIZE = INSTR_STRUCT.size
 
 MEM_WRITE_FMT = "<IB"
 MEM_WRITE_SIZE = struct.calcsize(MEM_WRITE_FMT)
@@ -16,6 +29,51 @@ MEM_WRITE_SIZE = struct.calcsize(MEM_WRITE_FMT)
 KEY_EVENT_FMT = "<BBIH"
 KEY_EVENT_SIZE = struct.calcsize(KEY_EVENT_FMT)
 
+# Whole-record layouts: the leading pad byte skips the record type tag, so
+# runs of same-type records can be decoded straight out of the trace buffer.
+INSTR_RECORD = struct.Struct("<x" + INSTR_FMT[1:])
+MEM_WRITE_RECORD = struct.Struct("<x" + MEM_WRITE_FMT[1:])
+KEY_EVENT_RECORD = struct.Struct("<x" + KEY_EVENT_FMT[1:])
+
+INSTR_RAW_RECORD = struct.Struct(f"<x{INSTR_SIZE}s")
+
+# One single-field record layout per IDX_* value, used by instr_column.
+INSTR_COLUMNS = tuple(
+    struct.Struct(f"<{1 + struct.calcsize('<' + INSTR_FMT[1:1 + i])}x{code}")
+    for i, code in enumerate(INSTR_FMT[1:])
+)
+
+# Max instruction records decoded per iter_unpack batch.
+INSTR_RUN_LOOKAHEAD = 64
+
+# Read size for traces that cannot be mmapped (compressed or piped input).
+READ_CHUNK_SIZE = 1 << 20
+
+# Instructions indexed at a time by the --stop-on-sp-underflow prescan.
+SP_SCAN_SLICE_SIZE = 1 << 16
+
+INSTR_TEMPLATE = (
+    "PC=0x%04x OP=0x%08x CLK=%d "
+    "AF=0x%04x BC=0x%04x DE=0x%04x HL=0x%04x "
+    "IX=0x%04x IY=0x%04x SP=0x%04x PC'=0x%04x "
+    "IR=0x%04x WZ=0x%04x WZ2=0x%04x "
+    "AF2=0x%04x BC2=0x%04x DE2=0x%04x HL2=0x%04x "
+    "IFF1=%d IFF2=%d IM=%d R7=%d HALT=%d"
+)
+INSTR_TEMPLATE_BYTES = INSTR_TEMPLATE.encode("ascii")
+
+FORTH_TRACE_TEMPLATE = "%8d PC=0x%04x %s BC=0x%04x SP=0x%04x STACK=[%s]\n"
+FORTH_TRACE_BUFFER_SIZE = 1 << 20
+
+INDEX_MAGIC = b"TLMI"
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct("<4sHHQqQQQQ")
+INDEX_KINDS = ("instr", "mem_write", "key_event")
+# The --dump-ram cache keeps every mem write offset but only every
+# INDEX_INSTR_STRIDE-th instruction offset; instr_offset scans from there.
+INDEX_CACHED_KINDS = ("instr", "mem_write")
+INDEX_INSTR_STRIDE = 4096
+
 IDX_PC = 0
 IDX_OPCODE = 1
 IDX_CLOCK = 2
@@ -40,6 +98,47 @@ IDX_IM = 20
 IDX_R7 = 21
 IDX_HALTED = 22
 
+
+def instr_view(*fields):
+    """Return a Struct for an instruction payload that unpacks only fields."""
+    fmt = "<"
+    pos = 0
+    for field in fields:
+        code = INSTR_FMT[1 + field]
+        offset = struct.calcsize("<" + INSTR_FMT[1:1 + field])
+        if offset > pos:
+            fmt += f"{offset - pos}x"
+        fmt += code
+        pos = offset + struct.calcsize("<" + code)
+    if INSTR_SIZE > pos:
+        fmt += f"{INSTR_SIZE - pos}x"
+    return struct.Struct(fmt)
+
+
+# Narrow views of an instruction payload for loops that only need a few
+# registers; the full INSTR_FMT decode is deferred until a line is printed.
+INSTR_FLOW = instr_view(IDX_PC, IDX_OPCODE, IDX_SP, IDX_PC_REG)
+INSTR_FORTH = instr_view(IDX_PC, IDX_BC, IDX_SP)
+INSTR_FLOW_RECORD = struct.Struct("<x" + INSTR_FLOW.format[1:])
+
+# Flow event tags. Events are tuples starting with one of these:
+#   (FLOW_CALL, idx, from, to, ret, depth)
+#   (FLOW_RET, idx, from, to, expected_ret, depth, mismatch)
+#   (FLOW_JUMP, idx, from, to, kind, taken)
+#   (FLOW_ASYNC, idx, from, to, ret, depth)
+#   (FLOW_RET_UNDERFLOW, idx, from, to)
+FLOW_CALL = 0
+FLOW_RET = 1
+FLOW_JUMP = 2
+FLOW_ASYNC = 3
+FLOW_RET_UNDERFLOW = 4
+
+# build_pc_flags bits for the Forth trace loop.
+FORTH_WORD = 0x01
+FORTH_COLON = 0x02
+FORTH_EXIT = 0x04
+FORTH_DROP = 0x08
+
 RET_COND = {0xC0, 0xC8, 0xD0, 0xD8, 0xE0, 0xE8, 0xF0, 0xF8}
 RET_UNCOND = {0xC9}
 CALL_COND = {0xC4, 0xCC, 0xD4, 0xDC, 0xE4, 0xEC, 0xF4, 0xFC}
@@ -53,12 +152,45 @@ JR_UNCOND = {0x18}
 DJNZ = {0x10}
 ED_RET = {0x45, 0x4D, 0x55, 0x5D, 0x65, 0x6D, 0x75, 0x7D}
 
+# (opcodes, kind, base_len, conditional) for unprefixed control flow.
+FLOW_OPCODES = (
+    (RET_UNCOND, "ret", 1, False),
+    (RET_COND, "ret", 1, True),
+    (CALL_UNCOND, "call", 3, False),
+    (CALL_COND, "call", 3, True),
+    (RST_SET, "rst", 1, False),
+    (JP_UNCOND, "jp", 3, False),
+    (JP_COND, "jp", 3, True),
+    (JP_INDIRECT, "jp", 1, False),
+    (JR_UNCOND, "jr", 2, False),
+    (JR_COND, "jr", 2, True),
+    (DJNZ, "djnz", 2, True),
+)
+
+
+def build_flow_table(entries, len_delta=0):
+    """Return a 256-entry tuple mapping an opcode's low byte to its flow info."""
+    table = [None] * 256
+    for opcodes, kind, base_len, conditional in entries:
+        for low in opcodes:
+            table[low] = {"kind": kind, "len": base_len + len_delta,
+                          "conditional": conditional}
+    return tuple(table)
+
+
+# control_flow_info results per low byte. The dicts are shared between
+# lookups, so callers must not modify them.
+FLOW_BASE = build_flow_table(FLOW_OPCODES)
+FLOW_INDEXED = build_flow_table(FLOW_OPCODES, 1)  # DD/FD prefix adds a byte
+FLOW_ED = build_flow_table(((ED_RET, "ret", 2, False),))
+
 
 def opcode_prefix(opcode):
-    if opcode & 0xFF000000 in (0xDDCB0000, 0xFDCB0000):
-        return opcode & 0xFF000000
+    top = opcode >> 16
+    if top == 0xDDCB or top == 0xFDCB:
+        return top << 16
     prefix = opcode & 0xFF00
-    if prefix in (0xDD00, 0xFD00, 0xCB00, 0xED00):
+    if prefix == 0xDD00 or prefix == 0xFD00 or prefix == 0xCB00 or prefix == 0xED00:
         return prefix
     return 0
 
@@ -66,100 +198,112 @@ def opcode_prefix(opcode):
 def control_flow_info(opcode):
     prefix = opcode_prefix(opcode)
     low = opcode & 0xFF
-    base_len = 1
-    kind = None
-    conditional = False
-
-    if prefix in (0xCB00, 0xDDCB0000, 0xFDCB0000):
-        return None
-
-    if prefix == 0xED00 and low in ED_RET:
-        return {"kind": "ret", "len": 2, "conditional": False}
+    if prefix == 0:
+        return FLOW_BASE[low]
+    if prefix in (0xDD00, 0xFD00):
+        return FLOW_INDEXED[low]
     if prefix == 0xED00:
-        return None
+        return FLOW_ED[low]
+    return None
 
-    if low in RET_UNCOND:
-        kind = "ret"
-    elif low in RET_COND:
-        kind = "ret"
-        conditional = True
-    elif low in CALL_UNCOND:
-        kind = "call"
-        base_len = 3
-    elif low in CALL_COND:
-        kind = "call"
-        conditional = True
-        base_len = 3
-    elif low in RST_SET:
-        kind = "rst"
-    elif low in JP_UNCOND:
-        kind = "jp"
-        base_len = 3
-    elif low in JP_COND:
-        kind = "jp"
-        conditional = True
-        base_len = 3
-    elif low in JP_INDIRECT:
-        kind = "jp"
-    elif low in JR_UNCOND:
-        kind = "jr"
-        base_len = 2
-    elif low in JR_COND:
-        kind = "jr"
-        conditional = True
-        base_len = 2
-    elif low in DJNZ:
-        kind = "djnz"
-        conditional = True
-        base_len = 2
-    else:
-        return None
 
-    if prefix in (0xDD00, 0xFD00):
-        base_len += 1
+class FlowInfoCache(dict):
+    """control_flow_info results keyed by opcode, computed on first lookup."""
 
-    return {"kind": kind, "len": base_len, "conditional": conditional}
+    def __missing__(self, opcode):
+        info = self[opcode] = control_flow_info(opcode)
+        return info
 
 
 def format_flow(event):
-    if event["type"] == "call":
-        return (
-            f"{event['idx']:>8} CALL 0x{event['from']:04x} -> 0x{event['to']:04x} "
-            f"ret=0x{event['ret']:04x} depth={event['depth']}"
-        )
-    if event["type"] == "ret":
-        suffix = ""
-        if event.get("mismatch"):
-            suffix = f" mismatch ret=0x{event['ret']:04x}"
-        return (
-            f"{event['idx']:>8} RET  0x{event['from']:04x} -> 0x{event['to']:04x} "
-            f"depth={event['depth']}{suffix}"
-        )
-    if event["type"] == "jump":
-        taken = "taken" if event["taken"] else "not-taken"
-        return (
-            f"{event['idx']:>8} JUMP {taken} 0x{event['from']:04x} -> 0x{event['to']:04x} "
-            f"kind={event['kind']}"
-        )
-    if event["type"] == "async":
-        return (
-            f"{event['idx']:>8} ASYNC 0x{event['from']:04x} -> 0x{event['to']:04x} "
-            f"ret=0x{event['ret']:04x} depth={event['depth']}"
-        )
-    if event["type"] == "ret-underflow":
-        return (
-            f"{event['idx']:>8} RET-UNDERFLOW 0x{event['from']:04x} -> 0x{event['to']:04x}"
-        )
-    return f"{event['idx']:>8} FLOW {event}"
+    kind = event[0]
+    if kind == FLOW_CALL:
+        return "%8d CALL 0x%04x -> 0x%04x ret=0x%04x depth=%d" % event[1:]
+    if kind == FLOW_RET:
+        _, idx, src, dst, ret, depth, mismatch = event
+        line = "%8d RET  0x%04x -> 0x%04x depth=%d" % (idx, src, dst, depth)
+        if mismatch:
+            line += " mismatch ret=0x%04x" % ret
+        return line
+    if kind == FLOW_JUMP:
+        _, idx, src, dst, jump_kind, taken = event
+        return "%8d JUMP %s 0x%04x -> 0x%04x kind=%s" % (
+            idx, "taken" if taken else "not-taken", src, dst, jump_kind)
+    if kind == FLOW_ASYNC:
+        return "%8d ASYNC 0x%04x -> 0x%04x ret=0x%04x depth=%d" % event[1:]
+    return "%8d RET-UNDERFLOW 0x%04x -> 0x%04x" % event[1:]
+
+
+class FlowTracker:
+    """Follow calls and returns; step returns True on a ret-underflow stop."""
+
+    def __init__(self, emit, window, print_flow=False, print_untaken=False,
+                 stop_on_ret_underflow=False):
+        self.emit = emit
+        self.print_flow = print_flow
+        self.print_untaken = print_untaken
+        self.stop_on_ret_underflow = stop_on_ret_underflow
+        self.flow_window = deque(maxlen=max(0, window))
+        self.call_stack = array("H")
+
+    def record(self, event):
+        if self.print_flow:
+            self.emit(format_flow(event) + "\n")
+        self.flow_window.append(event)
+
+    def dump_context(self):
+        if not self.flow_window:
+            return
+        self.emit("Recent control flow:\n")
+        for event in self.flow_window:
+            self.emit(format_flow(event) + "\n")
+
+    def step(self, idx, pc, sp, pc_reg, flow, prev_pc_reg, prev_sp):
+        """Process one instruction; flow is its control_flow_info result."""
+        call_stack = self.call_stack
+        if prev_pc_reg is not None and pc != prev_pc_reg:
+            if prev_sp is not None and ((prev_sp - 2) & 0xFFFF) == sp:
+                event = (FLOW_ASYNC, idx, prev_pc_reg, pc, prev_pc_reg,
+                         len(call_stack) + 1)
+                call_stack.append(prev_pc_reg)
+                self.record(event)
+
+        if not flow:
+            return False
+        seq_pc = (pc + flow["len"]) & 0xFFFF
+        taken = (pc_reg != seq_pc)
+        is_cond = flow["conditional"]
+        if not taken and is_cond and self.print_untaken:
+            self.record((FLOW_JUMP, idx, pc, pc_reg, flow["kind"], False))
+        if taken or not is_cond:
+            if flow["kind"] in {"call", "rst"}:
+                event = (FLOW_CALL, idx, pc, pc_reg, seq_pc, len(call_stack) + 1)
+                call_stack.append(seq_pc)
+                self.record(event)
+            elif flow["kind"] == "ret":
+                if call_stack:
+                    expected = call_stack.pop()
+                    self.record((FLOW_RET, idx, pc, pc_reg, expected,
+                                 len(call_stack), expected != pc_reg))
+                else:
+                    event = (FLOW_RET_UNDERFLOW, idx, pc, pc_reg)
+                    self.record(event)
+                    if self.stop_on_ret_underflow:
+                        self.emit("Return underflow detected:\n")
+                        self.emit(format_flow(event) + "\n")
+                        self.dump_context()
+                        return True
+            else:
+                if taken or self.print_untaken:
+                    self.record((FLOW_JUMP, idx, pc, pc_reg, flow["kind"], taken))
+        return False
 
 
 def read_header(fp):
     data = fp.read(HEADER_SIZE)
     if len(data) != HEADER_SIZE:
         raise ValueError("short header")
-    magic, version, flags, range_start, range_end, init_size = struct.unpack(
-        HEADER_FMT, data
-    )
+    magic, version, flags, range_start, range_end, init_size = HEADER_STRUCT.unpack(data)
     if magic != MAGIC:
         raise ValueError("bad magic")
     init = fp.read(init_size)
@@ -175,119 +319,330 @@ def read_header(fp):
     }
 
 
-def iter_records(fp, resync=False):
-    while True:
-        typ = fp.read(1)
-        if not typ:
-            return
-        rec_type = typ[0]
+def open_trace(path):
+    """Open a trace for reading, decompressing .gz/.bz2/.xz/.zst on the fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rb")
+    if path.endswith(".zst"):
+        try:
+            from compression import zstd
+        except ImportError:
+            try:
+                import zstandard as zstd
+            except ImportError:
+                raise ValueError(
+                    "reading .zst traces needs Python 3.14 or the zstandard module"
+                ) from None
+        return zstd.open(path, "rb")
+    return open(path, "rb")
+
+
+def map_trace(fp):
+    """Return an mmap of the whole trace file, or None if fp is not a plain file."""
+    if not isinstance(fp, io.BufferedReader):
+        return None
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+
+def parse_records(buf, pos, final, resync=False, raw_instr=False):
+    """Yield records from buf[pos:]; a cut-off record is left unless final."""
+    end = len(buf)
+    instr_len = INSTR_RECORD.size
+    mem_write_len = MEM_WRITE_RECORD.size
+    key_event_len = KEY_EVENT_RECORD.size
+    unpack_mem_write = MEM_WRITE_RECORD.unpack_from
+    unpack_key_event = KEY_EVENT_RECORD.unpack_from
+    while pos < end:
+        rec_type = buf[pos]
         if rec_type == 0x01:
-            payload = fp.read(INSTR_SIZE)
-            if len(payload) != INSTR_SIZE:
+            tags = buf[pos:pos + instr_len * INSTR_RUN_LOOKAHEAD:instr_len]
+            run = min(len(tags) - len(tags.lstrip(b"\x01")),
+                      (end - pos) // instr_len)
+            if not run:
+                if not final:
+                    break
                 raise ValueError("short instruction record")
-            fields = struct.unpack(INSTR_FMT, payload)
-            yield (rec_type, fields)
+            run_end = pos + run * instr_len
+            if raw_instr:
+                for (raw,) in INSTR_RAW_RECORD.iter_unpack(buf[pos:run_end]):
+                    yield (rec_type, raw)
+            else:
+                for fields in INSTR_RECORD.iter_unpack(buf[pos:run_end]):
+                    yield (rec_type, fields)
+            pos = run_end
         elif rec_type == 0x02:
-            payload = fp.read(MEM_WRITE_SIZE)
-            if len(payload) != MEM_WRITE_SIZE:
+            if pos + mem_write_len > end:
+                if not final:
+                    break
                 raise ValueError("short mem write record")
-            addr, value = struct.unpack(MEM_WRITE_FMT, payload)
-            yield (rec_type, (addr, value))
+            yield (rec_type, unpack_mem_write(buf, pos))
+            pos += mem_write_len
         elif rec_type == 0x03:
-            payload = fp.read(KEY_EVENT_SIZE)
-            if len(payload) != KEY_EVENT_SIZE:
+            if pos + key_event_len > end:
+                if not final:
+                    break
                 raise ValueError("short key event record")
-            action, key, clock, pc = struct.unpack(KEY_EVENT_FMT, payload)
-            yield (rec_type, (action, key, clock, pc))
+            yield (rec_type, unpack_key_event(buf, pos))
+            pos += key_event_len
         else:
             if resync:
+                pos += 1
                 continue
             raise ValueError(f"unknown record type {rec_type}")
+    return pos
+
+
+def iter_records(fp, resync=False, raw_instr=False):
+    """Yield (rec_type, payload) for each record after the header."""
+    mm = map_trace(fp)
+    if mm is not None:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            yield from parse_records(mm, fp.tell(), True, resync, raw_instr)
+        finally:
+            mm.close()
+        return
+
+    tail = b""
+    while True:
+        chunk = fp.read(READ_CHUNK_SIZE)
+        buf = tail + chunk
+        pos = yield from parse_records(buf, 0, not chunk, resync, raw_instr)
+        if not chunk:
+            return
+        tail = buf[pos:]
+
+
+def build_index(buf, pos, resync=False, instr_limit=None, instr_stride=1):
+    """Collect per-type record offsets, keeping the first parse error."""
+    index = {kind: array("q") for kind in INDEX_KINDS}
+    index["error"] = None
+    index["partial"] = False
+    index["instr_stride"] = instr_stride
+    instr_count = 0
+    instr = index["instr"]
+    mem_write = index["mem_write"]
+    key_event = index["key_event"]
+    end = len(buf)
+    instr_len = INSTR_RECORD.size
+    mem_write_len = MEM_WRITE_RECORD.size
+    key_event_len = KEY_EVENT_RECORD.size
+    while pos < end:
+        rec_type = buf[pos]
+        if rec_type == 0x01:
+            tags = buf[pos:pos + instr_len * INSTR_RUN_LOOKAHEAD:instr_len]
+            run = min(len(tags) - len(tags.lstrip(b"\x01")),
+                      (end - pos) // instr_len)
+            if not run:
+                index["error"] = "short instruction record"
+                break
+            run_end = pos + run * instr_len
+            skip = -instr_count % instr_stride
+            instr.extend(range(pos + skip * instr_len, run_end,
+                               instr_len * instr_stride))
+            instr_count += run
+            pos = run_end
+            if instr_limit is not None and instr_count > instr_limit:
+                index["partial"] = pos < end
+                break
+        elif rec_type == 0x02:
+            if pos + mem_write_len > end:
+                index["error"] = "short mem write record"
+                break
+            mem_write.append(pos)
+            pos += mem_write_len
+        elif rec_type == 0x03:
+            if pos + key_event_len > end:
+                index["error"] = "short key event record"
+                break
+            key_event.append(pos)
+            pos += key_event_len
+        elif resync:
+            pos += 1
+        else:
+            index["error"] = f"unknown record type {rec_type}"
+            break
+    index["pos"] = pos
+    index["instr_count"] = instr_count
+    return index
+
+
+def load_index(fp, buf, pos, resync=False, instr_limit=None):
+    """Return the --dump-ram index for fp, reusing a fresh <trace>.idx cache."""
+    if not isinstance(buf, mmap.mmap):
+        return build_index(buf, pos, resync, instr_limit, INDEX_INSTR_STRIDE)
+    st = os.fstat(fp.fileno())
+    idx_path = fp.name + ".idx"
+    try:
+        with open(idx_path, "rb") as idx:
+            (magic, version, flags, size, mtime_ns, instr_count,
+             *counts, error_len) = INDEX_HEADER.unpack(idx.read(INDEX_HEADER.size))
+            if (magic == INDEX_MAGIC and version == INDEX_VERSION
+                    and flags == int(resync) and size == st.st_size
+                    and mtime_ns == st.st_mtime_ns):
+                index = {}
+                for kind, n in zip(INDEX_CACHED_KINDS, counts):
+                    index[kind] = array("q")
+                    index[kind].fromfile(idx, n)
+                index["error"] = idx.read(error_len).decode() or None
+                index["partial"] = False
+                index["instr_stride"] = INDEX_INSTR_STRIDE
+                index["instr_count"] = instr_count
+                return index
+    except (OSError, EOFError, struct.error, UnicodeDecodeError):
+        pass
+
+    index = build_index(buf, pos, resync, instr_limit, INDEX_INSTR_STRIDE)
+    if index["partial"]:
+        return index
+    error = (index["error"] or "").encode()
+    try:
+        with open(idx_path, "wb") as idx:
+            idx.write(INDEX_HEADER.pack(
+                INDEX_MAGIC, INDEX_VERSION, int(resync),
+                st.st_size, st.st_mtime_ns, index["instr_count"],
+                *(len(index[kind]) for kind in INDEX_CACHED_KINDS), len(error)))
+            for kind in INDEX_CACHED_KINDS:
+                index[kind].tofile(idx)
+            idx.write(error)
+    except OSError:
+        pass
+    return index
+
+
+def instr_offset(buf, index, n, resync=False):
+    """Return the offset of instruction n, scanning on from its checkpoint."""
+    stride = index["instr_stride"]
+    pos = index["instr"][n // stride]
+    return build_index(buf, pos, resync, n % stride)["instr"][n % stride]
+
+
+def dump_ram_indexed(fp, buf, hdr, at_index, resync=False):
+    """Return (ram, instr_index) for --at; instr_index is None past the end."""
+    pos = fp.tell()
+    # Nothing past instruction at_index is replayed, so an uncached scan
+    # can stop there instead of walking the rest of the trace.
+    instr_limit = at_index if at_index >= 0 else None
+    index = load_index(fp, buf, pos, resync, instr_limit)
+    if 0 <= at_index < index["instr_count"]:
+        stop = instr_offset(buf, index, at_index, resync)
+    elif index["error"]:
+        raise ValueError(index["error"])
+    else:
+        stop = len(buf)
+        at_index = None
+
+    ram = bytearray(hdr["init"])
+    mem_write = index["mem_write"]
+    replay_mem_writes(ram, hdr, buf, mem_write[:bisect.bisect_left(mem_write, stop)])
+    return ram, at_index
+
+
+def replay_mem_writes(ram, hdr, buf, offsets):
+    """Apply the mem write records at offsets (in trace order) to ram."""
+    start = hdr["range_start"]
+    end = hdr["range_end"]
+    # Only the last write to each address matters.
+    final = dict(map(MEM_WRITE_RECORD.unpack_from, repeat(buf, len(offsets)),
+                     offsets))
+    for addr, value in final.items():
+        if start <= addr <= end:
+            ram[addr - start] = value
+
+
+def instr_column(buf, offsets, field):
+    """Iterate one IDX_* field of the instruction records at offsets."""
+    column = INSTR_COLUMNS[field]
+    return map(itemgetter(0), map(column.unpack_from, repeat(buf), offsets))
+
+
+def find_sp_underflow(buf, pos, threshold, resync=False):
+    """Return whether an instruction in buf[pos:] has SP below threshold."""
+    while True:
+        index = build_index(buf, pos, resync, SP_SCAN_SLICE_SIZE)
+        if any(map(threshold.__gt__, instr_column(buf, index["instr"], IDX_SP))):
+            return True
+        if not index["partial"]:
+            break
+        pos = index["pos"]
+    if index["error"]:
+        raise ValueError(index["error"])
+    return False
+
+
+def format_label(labelmap, pc):
+    name, base = labelmap.lookup(pc)
+    if name:
+        return f" {name}+0x{pc - base:x}"
+    return ""
 
 
 def format_instr(fields, labelmap=None):
-    (
-        pc,
-        opcode,
-        clock,
-        af,
-        bc,
-        de,
-        hl,
-        ix,
-        iy,
-        sp,
-        pc_reg,
-        ir,
-        wz,
-        wz2,
-        af2,
-        bc2,
-        de2,
-        hl2,
-        iff1,
-        iff2,
-        im,
-        r7,
-        halted,
-    ) = fields
-    label = ""
+    line = INSTR_TEMPLATE % fields
     if labelmap is not None:
-        name, base = labelmap.lookup(pc)
-        if name:
-            label = f" {name}+0x{pc - base:x}"
-
-    return (
-        f"PC=0x{pc:04x} OP=0x{opcode:08x} CLK={clock} "
-        f"AF=0x{af:04x} BC=0x{bc:04x} DE=0x{de:04x} HL=0x{hl:04x} "
-        f"IX=0x{ix:04x} IY=0x{iy:04x} SP=0x{sp:04x} PC'=0x{pc_reg:04x} "
-        f"IR=0x{ir:04x} WZ=0x{wz:04x} WZ2=0x{wz2:04x} "
-        f"AF2=0x{af2:04x} BC2=0x{bc2:04x} DE2=0x{de2:04x} HL2=0x{hl2:04x} "
-        f"IFF1={iff1} IFF2={iff2} IM={im} R7={r7} HALT={halted}{label}"
-    )
+        line += format_label(labelmap, fields[IDX_PC])
+    return line
 
 
 class LabelMap:
     def __init__(self, labels):
-        self.labels = sorted(labels, key=lambda x: x[0])
+        self.labels = sorted(labels, key=itemgetter(0))
+        self.addrs = [addr for addr, _ in self.labels]
+        self.names = [name for _, name in self.labels]
         self.by_name = {name: addr for addr, name in labels}
+        # Label covering each 16-bit address, so looking up a Z80 PC is a
+        # single list index. Only the last label at an address is kept,
+        # matching what bisect_right picks for the rest of the range.
+        self.table = [(None, None)] * 0x10000
+        starts = [(name, addr) for addr, name in dict(zip(self.addrs, self.names)).items()
+                  if addr < 0x10000]
+        ends = [addr for _, addr in starts[1:]] + [0x10000]
+        for entry, end in zip(starts, ends):
+            self.table[entry[1]:end] = [entry] * (end - entry[1])
+        # Last bisect result and the address range [lo, hi) it is valid for,
+        # for addresses past the table.
+        self.last_lo = self.last_hi = 0
+        self.last = (None, None)
 
     @staticmethod
     def load(path):
-        import json
+        try:
+            from orjson import loads
+        except ImportError:
+            from json import loads
 
-        data = json.loads(open(path, "r").read())
+        with open(path, "rb") as fp:
+            data = loads(fp.read())
         labels = [(entry["addr"], entry["name"]) for entry in data.get("labels", [])]
         return LabelMap(labels)
 
     def lookup(self, addr):
-        lo = 0
-        hi = len(self.labels) - 1
-        best = None
-        while lo <= hi:
-            mid = (lo + hi) // 2
-            a, name = self.labels[mid]
-            if a == addr:
-                return (name, a)
-            if a < addr:
-                best = (name, a)
-                lo = mid + 1
-            else:
-                hi = mid - 1
-        return best if best else (None, None)
+        if addr < 0x10000:
+            return self.table[addr]
+        return self.lookup_bisect(addr)
+
+    def lookup_bisect(self, addr):
+        if self.last_lo <= addr < self.last_hi:
+            return self.last
+        addrs = self.addrs
+        i = bisect.bisect_right(addrs, addr) - 1
+        self.last_lo = addrs[i] if i >= 0 else -1
+        self.last_hi = addrs[i + 1] if i + 1 < len(addrs) else 1 << 32
+        self.last = (self.names[i], addrs[i]) if i >= 0 else (None, None)
+        return self.last
 
     def addr_for(self, name):
         return self.by_name.get(name)
 
 
-def read_u16(mem_read, addr):
-    lo = mem_read(addr)
-    hi = mem_read(addr + 1)
-    if lo is None or hi is None:
-        return None
-    return lo | (hi << 8)
-
-
 def read_ram_u16(ram, hdr, addr):
     start = hdr["range_start"]
     end = hdr["range_end"]
@@ -302,7 +657,7 @@ def infer_docol_target(words, mem_read):
     for cfa in words:
         if mem_read(cfa) != 0xCD:
             continue
-        target = read_u16(mem_read, cfa + 1)
+        target = mem_read.u16(cfa + 1)
         if target is None:
             continue
         counts[target] = counts.get(target, 0) + 1
@@ -318,24 +673,66 @@ def build_colon_words(words, mem_read, docol_target):
     for cfa, name in words.items():
         if mem_read(cfa) != 0xCD:
             continue
-        target = read_u16(mem_read, cfa + 1)
+        target = mem_read.u16(cfa + 1)
         if target == docol_target:
             colon.add(cfa)
     return colon
 
 
-def make_mem_reader(ram, hdr, rom_bytes=None):
-    start = hdr["range_start"]
-    end = hdr["range_end"]
-
-    def read_u8(addr):
-        if start <= addr <= end:
-            return ram[addr - start]
+def build_pc_flags(words, colon_words=(), exit_addr=None, drop_addr=None):
+    """Return a table of FORTH_* bits indexed by PC, sized to the last word."""
+    flags = bytearray(max(words) + 1)
+    for cfa in words:
+        flags[cfa] = FORTH_WORD
+    for cfa in colon_words:
+        flags[cfa] |= FORTH_COLON
+    if exit_addr is not None:
+        flags[exit_addr] |= FORTH_EXIT
+    if drop_addr is not None:
+        flags[drop_addr] |= FORTH_DROP
+    return flags
+
+
+class MemReader:
+    """Read trace RAM, falling back to a ROM image outside the RAM range."""
+
+    def __init__(self, ram, hdr, rom_bytes=None):
+        self.ram = ram
+        self.start = hdr["range_start"]
+        self.end = hdr["range_end"]
+        self.rom_bytes = rom_bytes
+
+    def __call__(self, addr):
+        if self.start <= addr <= self.end:
+            return self.ram[addr - self.start]
+        rom_bytes = self.rom_bytes
         if rom_bytes is not None and 0 <= addr < len(rom_bytes):
             return rom_bytes[addr]
         return None
 
-    return read_u8
+    def u16(self, addr):
+        start = self.start
+        if start <= addr and addr + 1 <= self.end:
+            off = addr - start
+            return self.ram[off] | (self.ram[off + 1] << 8)
+        lo = self(addr)
+        hi = self(addr + 1)
+        if lo is None or hi is None:
+            return None
+        return lo | (hi << 8)
+
+    def block(self, addr, size):
+        """Return up to size bytes at addr, stopping at an unmapped address."""
+        start = self.start
+        if start <= addr and addr + size - 1 <= self.end:
+            return bytes(self.ram[addr - start:addr - start + size])
+        data = bytearray()
+        for a in range(addr, addr + size):
+            b = self(a)
+            if b is None:
+                break
+            data.append(b)
+        return bytes(data)
 
 
 def parse_forth_dictionary(latest_addr, mem_read, max_entries=20000):
@@ -344,20 +741,14 @@ def parse_forth_dictionary(latest_addr, mem_read, max_entries=20000):
     addr = latest_addr
     while addr and addr not in seen and len(words) < max_entries:
         seen.add(addr)
-        link = read_u16(mem_read, addr)
+        link = mem_read.u16(addr)
         if link is None:
             break
         len_flags = mem_read(addr + 2)
         if len_flags is None:
             break
         name_len = len_flags & 0x3F
-        name_bytes = []
-        for i in range(name_len):
-            b = mem_read(addr + 3 + i)
-            if b is None:
-                break
-            name_bytes.append(b)
-        name = bytes(name_bytes).decode("ascii", "replace")
+        name = mem_read.block(addr + 3, name_len).decode("ascii", "replace")
         cfa = addr + 3 + name_len + 1
         words[cfa] = name
         addr = link
@@ -380,9 +771,99 @@ def format_stack(ram, hdr, bc, sp, depth):
     return items
 
 
+class BatchedWriter:
+    """Collect output strings (or bytes) and pass them to fp in large joined writes."""
+
+    def __init__(self, fp, max_items=4096, binary=False):
+        self.fp = fp
+        self.max_items = max_items
+        self.buf = []
+        self.empty = b"" if binary else ""
+
+    def write(self, s):
+        self.buf.append(s)
+        if len(self.buf) >= self.max_items:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.fp.write(self.empty.join(self.buf))
+            self.buf.clear()
+        self.fp.flush()
+
+
+def run_print(fp, args, labelmap):
+    """Print the first --print instruction records and stop."""
+    sys.stdout.flush()
+    out = BatchedWriter(sys.stdout.buffer, binary=True)
+    printed = 0
+    try:
+        for rec_type, fields in iter_records(fp, resync=args.resync):
+            if rec_type == 0x01:
+                line = INSTR_TEMPLATE_BYTES % fields
+                if labelmap is not None:
+                    line += format_label(labelmap, fields[IDX_PC]).encode()
+                out.write(line + b"\n")
+                printed += 1
+                if printed >= args.print_count:
+                    break
+    finally:
+        out.flush()
+
+
+def write_ram_dump(path, ram):
+    # The image goes to the file with os.write() straight from the
+    # bytearray, with no copy and no buffered-IO layer in between.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(path, flags, 0o666)
+    try:
+        view = memoryview(ram)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def run_dump_ram(fp, buf, hdr, args, emit):
+    """Write the RAM snapshot for --dump-ram/--at using the record index."""
+    ram, at_index = dump_ram_indexed(fp, buf, hdr, args.at_index, args.resync)
+    write_ram_dump(args.dump_ram, ram)
+    if at_index is None:
+        emit(f"wrote RAM dump at end -> {args.dump_ram}\n")
+    else:
+        emit(f"wrote RAM dump at instruction {at_index} -> {args.dump_ram}\n")
+
+
+def run_flow(fp, buf, args, emit):
+    """Report control flow for --print-flow using the record index."""
+    index = build_index(buf, fp.tell(), args.resync)
+    flow_info = FlowInfoCache()
+    step = FlowTracker(emit, args.flow_window, True, args.print_untaken,
+                       False).step
+    unpack_flow = INSTR_FLOW_RECORD.unpack_from
+    prev_pc_reg = prev_sp = None
+    for instr_count, off in enumerate(index["instr"]):
+        pc, opcode, sp, pc_reg = unpack_flow(buf, off)
+        flow = flow_info[opcode]
+        if flow or pc != prev_pc_reg:
+            step(instr_count, pc, sp, pc_reg, flow, prev_pc_reg, prev_sp)
+        prev_pc_reg = pc_reg
+        prev_sp = sp
+    if index["error"]:
+        raise ValueError(index["error"])
+
+
+# (print, keys, dump, flow, other) modes that skip the general loop. The
+# dump and flow runs read the record index, so they need a mapped trace and
+# otherwise fall back to the streaming loop.
+PRINT_ONLY = (True, False, False, False, False)
+DUMP_ONLY = (False, False, True, False, False)
+FLOW_ONLY = (False, False, False, True, False)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Decode TilEm trace files")
-    parser.add_argument("trace", help="Trace file")
+    parser.add_argument("trace", help="Trace file (.gz, .bz2, .xz and .zst are decompressed)")
     parser.add_argument("--print", dest="print_count", type=int, default=0,
                         help="Print first N instruction records")
     parser.add_argument("--step", action="store_true",
@@ -430,13 +911,15 @@ def main():
 
     labelmap = LabelMap.load(args.labelmap) if args.labelmap else None
 
-    with open(args.trace, "rb") as fp:
+    with open_trace(args.trace) as fp:
         hdr = read_header(fp)
         print(
             f"version={hdr['version']} range=0x{hdr['range_start']:04x}-0x{hdr['range_end']:04x} "
             f"init_size={hdr['init_size']} flags=0x{hdr['flags']:04x}"
         )
 
+        range_start = hdr["range_start"]
+        range_end = hdr["range_end"]
         ram = None
         if args.dump_ram or args.forth_trace or args.forth_drop_underflow:
             ram = bytearray(hdr["init"])
@@ -447,295 +930,318 @@ def main():
             if args.forth_rom:
                 rom_bytes = open(args.forth_rom, "rb").read()
 
-            for rec_type, payload in iter_records(fp, resync=args.resync):
-                if rec_type == 0x02:
-                    addr, value = payload
-                    if hdr["range_start"] <= addr <= hdr["range_end"]:
-                        ram[addr - hdr["range_start"]] = value
-
-            latest_addr = args.forth_latest
-            if latest_addr is None and labelmap is not None:
-                latest_addr = labelmap.addr_for("var-latest")
-
-            if latest_addr is None:
-                print("error: missing LATEST address; use --labelmap or --forth-latest",
-                      file=sys.stderr)
-                sys.exit(1)
-
-            latest_val = read_u16(lambda a: ram[a - hdr["range_start"]]
-                                  if hdr["range_start"] <= a <= hdr["range_end"]
-                                  else None,
-                                  latest_addr)
-            if latest_val is None or latest_val == 0:
-                print("error: LATEST value is missing or zero", file=sys.stderr)
-                sys.exit(1)
-
-            mem_read = make_mem_reader(ram, hdr, rom_bytes)
-            words = parse_forth_dictionary(latest_val, mem_read)
-            if not words:
-                print("error: no Forth words found from dictionary", file=sys.stderr)
-                sys.exit(1)
-
-            name_to_addr = {}
-            for addr, name in words.items():
-                name_to_addr.setdefault(name, addr)
-            drop_addr = name_to_addr.get("DROP")
-            exit_addr = name_to_addr.get("EXIT")
-            sp0_addr = args.forth_sp0
-            if sp0_addr is None and labelmap is not None:
-                sp0_addr = labelmap.addr_for("var-sp0")
-            if args.forth_drop_underflow and sp0_addr is None:
-                print("error: missing SP0 address; use --labelmap or --forth-sp0",
-                      file=sys.stderr)
-                sys.exit(1)
-
-            docol_target = infer_docol_target(words, mem_read)
-            colon_words = build_colon_words(words, mem_read, docol_target)
-
-            if args.forth_trace == "-":
-                out = sys.stdout
-            elif args.forth_trace:
-                out = open(args.forth_trace, "w")
-            else:
-                out = None
-
+            # A mapped trace is indexed for the first pass and parsed again
+            # from the mapping; other input is streamed twice, re-opening the
+            # trace for the second pass.
+            mm = map_trace(fp)
+            second_fp = None
             try:
-                fp.seek(0)
-                hdr = read_header(fp)
-                ram = bytearray(hdr["init"])
-                instr_index = 0
-                forth_stack = []
-                last_word = None
-                prev_sp = None
-                for rec_type, payload in iter_records(fp, resync=args.resync):
-                    if rec_type == 0x02:
-                        addr, value = payload
-                        if hdr["range_start"] <= addr <= hdr["range_end"]:
-                            ram[addr - hdr["range_start"]] = value
-                        continue
-                    if rec_type != 0x01:
-                        continue
-
-                    pc = payload[IDX_PC]
-                    if pc in words:
+                # The dictionary is read from RAM as of the end of the trace.
+                if mm is not None:
+                    index = build_index(mm, fp.tell(), args.resync)
+                    if index["error"]:
+                        raise ValueError(index["error"])
+                    replay_mem_writes(ram, hdr, mm, index["mem_write"])
+                    records = parse_records(mm, fp.tell(), True, args.resync,
+                                            raw_instr=True)
+                else:
+                    for rec_type, payload in iter_records(fp, resync=args.resync,
+                                                          raw_instr=True):
+                        if rec_type == 0x02:
+                            addr, value = payload
+                            if range_start <= addr <= range_end:
+                                ram[addr - range_start] = value
+                    second_fp = open_trace(args.trace)
+                    read_header(second_fp)
+                    records = iter_records(second_fp, resync=args.resync,
+                                           raw_instr=True)
+
+                latest_addr = args.forth_latest
+                if latest_addr is None and labelmap is not None:
+                    latest_addr = labelmap.addr_for("var-latest")
+
+                if latest_addr is None:
+                    print("error: missing LATEST address; use --labelmap or --forth-latest",
+                          file=sys.stderr)
+                    sys.exit(1)
+
+                latest_val = read_ram_u16(ram, hdr, latest_addr)
+                if latest_val is None or latest_val == 0:
+                    print("error: LATEST value is missing or zero", file=sys.stderr)
+                    sys.exit(1)
+
+                mem_read = MemReader(ram, hdr, rom_bytes)
+                words = parse_forth_dictionary(latest_val, mem_read)
+                if not words:
+                    print("error: no Forth words found from dictionary", file=sys.stderr)
+                    sys.exit(1)
+
+                # Only DROP and EXIT are looked up by name; the walk stops once
+                # the newest definition of both has been seen.
+                name_to_addr = {}
+                for addr, name in words.items():
+                    if (name == "DROP" or name == "EXIT") and name not in name_to_addr:
+                        name_to_addr[name] = addr
+                        if len(name_to_addr) == 2:
+                            break
+                drop_addr = name_to_addr.get("DROP")
+                exit_addr = name_to_addr.get("EXIT")
+                sp0_addr = args.forth_sp0
+                if sp0_addr is None and labelmap is not None:
+                    sp0_addr = labelmap.addr_for("var-sp0")
+                if args.forth_drop_underflow and sp0_addr is None:
+                    print("error: missing SP0 address; use --labelmap or --forth-sp0",
+                          file=sys.stderr)
+                    sys.exit(1)
+
+                docol_target = infer_docol_target(words, mem_read)
+                colon_words = build_colon_words(words, mem_read, docol_target)
+                # Entering a word is rare, so the loop checks one table byte per
+                # instruction instead of probing words/colon_words.
+                if args.forth_drop_underflow:
+                    pc_flags = build_pc_flags(words, colon_words, exit_addr, drop_addr)
+                else:
+                    pc_flags = build_pc_flags(words)
+                pc_flags_len = len(pc_flags)
+
+                if args.forth_trace == "-":
+                    out_fp = sys.stdout
+                elif args.forth_trace:
+                    out_fp = open(args.forth_trace, "w", buffering=FORTH_TRACE_BUFFER_SIZE)
+                else:
+                    out_fp = None
+                out = BatchedWriter(out_fp) if out_fp is not None else None
+
+                try:
+                    ram = bytearray(hdr["init"])
+                    instr_index = 0
+                    forth_stack = array("I")  # CFAs of the colon words entered
+                    last_word = None
+                    prev_sp = None
+                    unpack_forth = INSTR_FORTH.unpack
+                    stack_depth = max(1, args.forth_stack_depth)
+                    for rec_type, payload in records:
+                        if rec_type == 0x02:
+                            addr, value = payload
+                            if range_start <= addr <= range_end:
+                                ram[addr - range_start] = value
+                            continue
+                        if rec_type != 0x01:
+                            continue
+
+                        pc, bc, sp = unpack_forth(payload)
+                        flags = pc_flags[pc] if pc < pc_flags_len else 0
+                        if not flags:
+                            prev_sp = sp
+                            instr_index += 1
+                            continue
+
                         last_word = words[pc]
-                        if args.forth_drop_underflow and pc in colon_words:
-                            forth_stack.append(words[pc])
-                        if args.forth_drop_underflow and exit_addr == pc:
+                        if flags & FORTH_COLON:
+                            forth_stack.append(pc)
+                        if flags & FORTH_EXIT:
                             if forth_stack:
                                 forth_stack.pop()
-                    if args.forth_trace and pc in words:
-                        bc = payload[IDX_BC]
-                        sp = payload[IDX_SP]
-                        stack = format_stack(ram, hdr, bc, sp,
-                                             max(1, args.forth_stack_depth))
-                        stack_str = " ".join(
-                            "??" if v is None else f"0x{v:04x}"
-                            for v in stack
-                        )
-                        out.write(
-                            f"{instr_index:>8} PC=0x{pc:04x} {words[pc]} "
-                            f"BC=0x{bc:04x} SP=0x{sp:04x} STACK=[{stack_str}]\n"
-                        )
-
-                    if args.forth_drop_underflow and drop_addr == pc:
-                        sp0_val = None
-                        if sp0_addr is not None:
-                            sp0_val = read_ram_u16(ram, hdr, sp0_addr)
-                        if sp0_val is not None and prev_sp is not None:
-                            if prev_sp >= sp0_val:
-                                caller = forth_stack[-1] if forth_stack else None
-                                state = "underflow" if prev_sp > sp0_val else "empty"
-                                print(f"DROP {state} stack detected:")
-                                print(
-                                    f"instr={instr_index} PC=0x{pc:04x} "
-                                    f"SP(before)=0x{prev_sp:04x} SP(after)=0x{payload[IDX_SP]:04x} "
-                                    f"SP0=0x{sp0_val:04x}"
-                                )
-                                if caller:
-                                    print(f"caller={caller}")
-                                if forth_stack:
-                                    print("forth-stack=" + " -> ".join(forth_stack))
-                                if last_word:
-                                    print(f"last-word={last_word}")
-                                print(format_instr(payload, labelmap))
-                                return
-
-                    prev_sp = payload[IDX_SP]
-                    instr_index += 1
+                        if out is not None:
+                            stack = format_stack(ram, hdr, bc, sp, stack_depth)
+                            stack_str = " ".join(["??" if v is None else "0x%04x" % v
+                                                  for v in stack])
+                            out.write(FORTH_TRACE_TEMPLATE % (instr_index, pc, last_word,
+                                                              bc, sp, stack_str))
+
+                        if flags & FORTH_DROP:
+                            sp0_val = None
+                            if sp0_addr is not None:
+                                sp0_val = read_ram_u16(ram, hdr, sp0_addr)
+                            if sp0_val is not None and prev_sp is not None:
+                                if prev_sp >= sp0_val:
+                                    if out is not None:
+                                        out.flush()
+                                    caller = words[forth_stack[-1]] if forth_stack else None
+                                    state = "underflow" if prev_sp > sp0_val else "empty"
+                                    print(f"DROP {state} stack detected:")
+                                    print(
+                                        f"instr={instr_index} PC=0x{pc:04x} "
+                                        f"SP(before)=0x{prev_sp:04x} SP(after)=0x{sp:04x} "
+                                        f"SP0=0x{sp0_val:04x}"
+                                    )
+                                    if caller:
+                                        print(f"caller={caller}")
+                                    if forth_stack:
+                                        print("forth-stack=" + " -> ".join(
+                                            [words[cfa] for cfa in forth_stack]))
+                                    if last_word:
+                                        print(f"last-word={last_word}")
+                                    print(format_instr(INSTR_STRUCT.unpack(payload),
+                                                       labelmap))
+                                    return
+
+                        prev_sp = sp
+                        instr_index += 1
+                finally:
+                    if out is not None:
+                        out.flush()
+                        if out_fp is not sys.stdout:
+                            out_fp.close()
             finally:
-                if out is not None and out is not sys.stdout:
-                    out.close()
+                if second_fp is not None:
+                    second_fp.close()
+                if mm is not None:
+                    mm.close()
+            return
+
+        # Runs that need only one kind of record skip the general loop below
+        # and its per-record flag checks. Key: (print, keys, dump, flow, other).
+        mode = (
+            args.print_count > 0,
+            bool(args.print_keys or args.stop_after_keys),
+            bool(args.dump_ram),
+            bool(args.print_flow or args.stop_on_ret_underflow),
+            bool(args.step or args.stop_on_sp_underflow),
+        )
+        if mode == PRINT_ONLY:
+            run_print(fp, args, labelmap)
+            return
+        indexed = mode == DUMP_ONLY or (mode == FLOW_ONLY
+                                        and not args.stop_on_ret_underflow)
+        mm = map_trace(fp) if indexed else None
+        if mm is not None:
+            stdout = BatchedWriter(sys.stdout)
+            try:
+                if mode == DUMP_ONLY:
+                    run_dump_ram(fp, mm, hdr, args, stdout.write)
+                else:
+                    run_flow(fp, mm, args, stdout.write)
+            finally:
+                stdout.flush()
+                mm.close()
             return
 
         instr_count = 0
         printed = 0
         key_presses = 0
-        underflow_window = []
-        flow_window = []
-        call_stack = []
+        underflow_window = deque(maxlen=max(0, args.sp_underflow_window * 2 + 1))
+        flow_info = FlowInfoCache()
         prev_pc_reg = None
         prev_sp = None
-
-        def record_flow(event):
-            if args.print_flow:
-                print(format_flow(event))
-            flow_window.append(event)
-            if len(flow_window) > args.flow_window:
-                flow_window.pop(0)
-
-        def dump_flow_context():
-            if not flow_window:
-                return
-            print("Recent control flow:")
-            for event in flow_window:
-                print(format_flow(event))
-        for rec_type, payload in iter_records(fp, resync=args.resync):
-            if rec_type == 0x02 and ram is not None:
-                addr, value = payload
-                if hdr["range_start"] <= addr <= hdr["range_end"]:
-                    ram[addr - hdr["range_start"]] = value
-                continue
-            if rec_type == 0x03:
-                action, key, clock, pc = payload
-                if args.print_keys:
-                    state = "down" if action else "up"
-                    print(f"{instr_count:>8} KEY {state} code={key} PC=0x{pc:04x} CLK={clock}")
-                if action:
-                    key_presses += 1
-                    if args.stop_after_keys and key_presses >= args.stop_after_keys:
-                        print(f"stop-after-keys reached at {key_presses} presses (instr {instr_count})")
+        stdout = BatchedWriter(sys.stdout)
+        emit = stdout.write
+        tracker = FlowTracker(emit, args.flow_window, args.print_flow,
+                              args.print_untaken, args.stop_on_ret_underflow)
+        flow_step = tracker.step
+        unpack_flow = INSTR_FLOW.unpack
+        # Loop-invariant options, bound to locals for the per-record checks.
+        print_count = args.print_count
+        step = args.step
+        print_keys = args.print_keys
+        stop_after_keys = args.stop_after_keys
+        dump_ram = args.dump_ram
+        dump_at = args.at_index if dump_ram else None
+        stop_on_sp_underflow = args.stop_on_sp_underflow
+        sp_threshold = args.sp_underflow_threshold
+
+        # Without these, instruction records only advance the count (and
+        # mark the --at point), so their payloads are never decoded.
+        decode = bool(print_count or step or args.print_flow
+                      or stop_on_sp_underflow or args.stop_on_ret_underflow)
+
+        # On its own, --stop-on-sp-underflow prints nothing unless SP drops
+        # below the threshold, so a plain file whose SP column never does
+        # skips the record loop.
+        if stop_on_sp_underflow and not any(mode[:4]) and not step:
+            mm = map_trace(fp)
+            if mm is not None:
+                try:
+                    underflow = find_sp_underflow(mm, fp.tell(), sp_threshold,
+                                                  args.resync)
+                finally:
+                    mm.close()
+                if not underflow:
+                    return
+
+        try:
+            for rec_type, payload in iter_records(fp, resync=args.resync,
+                                                  raw_instr=True):
+                if rec_type == 0x02 and ram is not None:
+                    addr, value = payload
+                    if range_start <= addr <= range_end:
+                        ram[addr - range_start] = value
+                    continue
+                if rec_type == 0x03:
+                    action, key, clock, pc = payload
+                    if print_keys:
+                        state = "down" if action else "up"
+                        emit(f"{instr_count:>8} KEY {state} code={key} PC=0x{pc:04x} CLK={clock}\n")
+                    if action:
+                        key_presses += 1
+                        if stop_after_keys and key_presses >= stop_after_keys:
+                            emit(f"stop-after-keys reached at {key_presses} presses (instr {instr_count})\n")
+                            break
+                    continue
+
+                if rec_type != 0x01:
+                    continue
+
+                if not decode:
+                    if instr_count == dump_at:
+                        write_ram_dump(dump_ram, ram)
+                        emit(f"wrote RAM dump at instruction {instr_count} -> {dump_ram}\n")
+                        return
+                    instr_count += 1
+                    continue
+
+                pc, opcode, sp, pc_reg = unpack_flow(payload)
+
+                flow = flow_info[opcode]
+                if flow or pc != prev_pc_reg:
+                    if flow_step(instr_count, pc, sp, pc_reg, flow,
+                                 prev_pc_reg, prev_sp):
                         break
-                continue
 
-            if rec_type != 0x01:
-                continue
-
-            pc = payload[IDX_PC]
-            opcode = payload[IDX_OPCODE]
-            sp = payload[IDX_SP]
-            pc_reg = payload[IDX_PC_REG]
-
-            if prev_pc_reg is not None and pc != prev_pc_reg:
-                if prev_sp is not None and ((prev_sp - 2) & 0xFFFF) == sp:
-                    event = {
-                        "type": "async",
-                        "idx": instr_count,
-                        "from": prev_pc_reg,
-                        "to": pc,
-                        "ret": prev_pc_reg,
-                        "depth": len(call_stack) + 1,
-                    }
-                    call_stack.append(prev_pc_reg)
-                    record_flow(event)
-
-            flow = control_flow_info(opcode)
-            if flow:
-                seq_pc = (pc + flow["len"]) & 0xFFFF
-                taken = (pc_reg != seq_pc)
-                is_cond = flow["conditional"]
-                if not taken and is_cond and args.print_untaken:
-                    record_flow({
-                        "type": "jump",
-                        "idx": instr_count,
-                        "from": pc,
-                        "to": pc_reg,
-                        "kind": flow["kind"],
-                        "taken": False,
-                    })
-                if taken or not is_cond:
-                    if flow["kind"] in {"call", "rst"}:
-                        event = {
-                            "type": "call",
-                            "idx": instr_count,
-                            "from": pc,
-                            "to": pc_reg,
-                            "ret": seq_pc,
-                            "depth": len(call_stack) + 1,
-                        }
-                        call_stack.append(seq_pc)
-                        record_flow(event)
-                    elif flow["kind"] == "ret":
-                        if call_stack:
-                            expected = call_stack.pop()
-                            event = {
-                                "type": "ret",
-                                "idx": instr_count,
-                                "from": pc,
-                                "to": pc_reg,
-                                "ret": expected,
-                                "depth": len(call_stack),
-                                "mismatch": expected != pc_reg,
-                            }
-                            record_flow(event)
-                        else:
-                            event = {
-                                "type": "ret-underflow",
-                                "idx": instr_count,
-                                "from": pc,
-                                "to": pc_reg,
-                            }
-                            record_flow(event)
-                            if args.stop_on_ret_underflow:
-                                print("Return underflow detected:")
-                                print(format_flow(event))
-                                dump_flow_context()
-                                break
-                    else:
-                        if taken or args.print_untaken:
-                            record_flow({
-                                "type": "jump",
-                                "idx": instr_count,
-                                "from": pc,
-                                "to": pc_reg,
-                                "kind": flow["kind"],
-                                "taken": taken,
-                            })
-
-            if args.print_count and printed < args.print_count:
-                print(format_instr(payload, labelmap))
-                printed += 1
-                if printed >= args.print_count and not args.step and not args.dump_ram:
-                    break
+                if print_count and printed < print_count:
+                    emit(format_instr(INSTR_STRUCT.unpack(payload), labelmap) + "\n")
+                    printed += 1
+                    if printed >= print_count and not step and not dump_ram:
+                        break
 
-            if args.step:
-                print(format_instr(payload, labelmap))
-                try:
-                    line = input("step> ")
-                except EOFError:
-                    line = "q"
-                if line.strip().lower() in {"q", "quit", "exit"}:
-                    break
+                if step:
+                    emit(format_instr(INSTR_STRUCT.unpack(payload), labelmap) + "\n")
+                    stdout.flush()
+                    try:
+                        line = input("step> ")
+                    except EOFError:
+                        line = "q"
+                    if line.strip().lower() in {"q", "quit", "exit"}:
+                        break
 
-            if args.stop_on_sp_underflow:
-                underflow_window.append((instr_count, payload))
-                if len(underflow_window) > (args.sp_underflow_window * 2 + 1):
-                    underflow_window.pop(0)
-                if sp < args.sp_underflow_threshold:
-                    print("SP underflow detected:")
-                    for idx, fields in underflow_window:
-                        print(f"{idx:>8} {format_instr(fields, labelmap)}")
-                    dump_flow_context()
-                    break
-            else:
-                if underflow_window:
-                    underflow_window.clear()
+                if stop_on_sp_underflow:
+                    underflow_window.append((instr_count, payload))
+                    if sp < sp_threshold:
+                        emit("SP underflow detected:\n")
+                        for idx, raw in underflow_window:
+                            fields = INSTR_STRUCT.unpack(raw)
+                            emit(f"{idx:>8} {format_instr(fields, labelmap)}\n")
+                        tracker.dump_context()
+                        break
+                else:
+                    if underflow_window:
+                        underflow_window.clear()
 
-            prev_pc_reg = pc_reg
-            prev_sp = sp
+                prev_pc_reg = pc_reg
+                prev_sp = sp
 
-            if args.dump_ram and instr_count == args.at_index:
-                with open(args.dump_ram, "wb") as out:
-                    out.write(ram)
-                print(f"wrote RAM dump at instruction {instr_count} -> {args.dump_ram}")
-                return
+                if instr_count == dump_at:
+                    write_ram_dump(dump_ram, ram)
+                    emit(f"wrote RAM dump at instruction {instr_count} -> {dump_ram}\n")
+                    return
 
-            instr_count += 1
+                instr_count += 1
 
-        if args.dump_ram:
-            with open(args.dump_ram, "wb") as out:
-                out.write(ram)
-            print(f"wrote RAM dump at end -> {args.dump_ram}")
+            if dump_ram:
+                write_ram_dump(dump_ram, ram)
+                emit(f"wrote RAM dump at end -> {dump_ram}\n")
+        finally:
+            stdout.flush()
 
 
 if __name__ == "__main__":